@@ -3,187 +3,497 @@
 from gremlin_python.driver.driver_remote_connection import DriverRemoteConnection
 from gremlin_python.process.anonymous_traversal import traversal
 from gremlin_python.process.graph_traversal import __
-from gremlin_python.process.traversal import Order
+from gremlin_python.process.traversal import Order, P, T
 from urllib.parse import urlparse
+from urllib.request import Request, urlopen
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import base64
+import csv
+import io
 import json
+import os
+import time
+
+import boto3
+
+# Policy JSON compresses 4-8x with zstd, cutting Neptune property storage and
+# websocket payload for large managed policies. Fall back to storing the raw
+# JSON string when the layer doesn't ship zstandard.
+try:
+    import zstandard
+    _zstd_compressor = zstandard.ZstdCompressor(level=3)
+    _zstd_decompressor = zstandard.ZstdDecompressor()
+except ImportError:
+    _zstd_compressor = None
+    _zstd_decompressor = None
 
 # Placeholder for the Neptune endpoint (We will get this from Terraform outputs)
-NEPTUNE_ENDPOINT = "wss://[YOUR_NEPTUNE_CLUSTER_ENDPOINT]:8182/gremlin" 
+NEPTUNE_ENDPOINT = "wss://[YOUR_NEPTUNE_CLUSTER_ENDPOINT]:8182/gremlin"
+
+# Number of websocket connections/workers for the Gremlin driver, and the
+# matching number of threads we use to submit per-role traversals. Throughput
+# stalls if the pool is smaller than the number of concurrent submitters.
+NEPTUNE_POOL_SIZE = 16
+
+# Neptune Bulk Loader staging. For large ingestions, even fully batched
+# Gremlin upserts are round-trip bound; the loader pulls CSVs from S3 at 1-2
+# orders of magnitude higher throughput. The bulk path kicks in when both
+# settings are present and the payload crosses the role threshold; smaller
+# (delta) payloads keep the online Gremlin path.
+NEPTUNE_LOAD_S3_BUCKET = os.environ.get('NEPTUNE_LOAD_S3_BUCKET', '')
+NEPTUNE_LOADER_ROLE_ARN = os.environ.get('NEPTUNE_LOADER_ROLE_ARN', '')
+BULK_LOAD_MIN_ROLES = 1000
+BULK_LOAD_POLL_SECONDS = 5
+
+# Cached connection/traversal source. Lambda containers are reused between
+# invocations, so keeping the WebSocket open lets warm invokes skip the
+# TLS + Gremlin handshake (~tens of ms) on every call.
+_remote_connection = None
+_g = None
 
 # Initialize the Traversal Source (g)
 # This setup assumes the lambda is within the Neptune VPC and can connect.
 def get_graph_traversal():
-    """Returns a graph traversal source connected to Neptune."""
+    """Returns the cached graph traversal source, connecting to Neptune lazily."""
     # Note: In a real environment, you must handle secure connection configuration.
+    global _remote_connection, _g
+    if _g is not None:
+        return _g
     try:
         url = urlparse(NEPTUNE_ENDPOINT)
-        return traversal().withRemote(
-            DriverRemoteConnection(
-                f'{url.scheme}://{url.netloc}{url.path}',
-                'g'
-            )
+        _remote_connection = DriverRemoteConnection(
+            f'{url.scheme}://{url.netloc}{url.path}',
+            'g',
+            pool_size=NEPTUNE_POOL_SIZE,
+            max_workers=NEPTUNE_POOL_SIZE
         )
+        _g = traversal().withRemote(_remote_connection)
+        return _g
     except Exception as e:
         print(f"Error connecting to Neptune: {e}")
         return None
 
-def save_iam_data_to_neptune(iam_data: list):
+def get_healthy_graph_traversal():
+    """
+    Returns the cached traversal source after probing the websocket with a
+    cheap traversal, reconnecting once if the cached connection went stale
+    (e.g. Neptune closed it between warm invocations).
+    """
+    g = get_graph_traversal()
+    if g is None:
+        return None
+    try:
+        g.V().limit(1).hasNext()
+        return g
+    except Exception:
+        close_graph_traversal()
+        return get_graph_traversal()
+
+def close_graph_traversal():
+    """Closes the cached connection (container shutdown, or to force a reconnect)."""
+    global _remote_connection, _g
+    if _remote_connection is not None:
+        try:
+            _remote_connection.close()
+        except Exception:
+            pass
+    _remote_connection = None
+    _g = None
+
+atexit.register(close_graph_traversal)
+
+# Action name -> vertex id for every action this container has resolved.
+# Action vertices are append-only (just a 'name' property), so once a name is
+# cached we can skip it for the rest of the container's lifetime — and edge
+# traversals can address the vertex by id, which skips the 'action'/'name'
+# index probe a has() lookup costs per edge. (mergeE would collapse the edge
+# upsert further, but it needs TinkerPop 3.6+ which our Neptune engine/driver
+# pairing doesn't offer.)
+_action_vertex_ids = {}
+
+def _ids_by_name(grouped):
+    """group() folds its values into single-element lists; unwrap to plain ids."""
+    return {name: ids[0] if isinstance(ids, list) else ids for name, ids in grouped.items()}
+
+def _bulk_upsert_actions(g, action_names):
+    """
+    Upserts action vertices, skipping names this container already resolved.
+    Existing ids are prefetched in one indexed within() lookup; only the
+    misses are created, in a single inject() traversal. All resolved ids are
+    recorded in _action_vertex_ids.
+    """
+    new_names = sorted(set(action_names) - _action_vertex_ids.keys())
+    if not new_names:
+        return
+
+    # One ('action', 'name') index probe for the whole list of names
+    existing = g.V().has('action', 'name', P.within(new_names)).group().by('name').by(T.id).next()
+    _action_vertex_ids.update(_ids_by_name(existing))
+
+    missing = [name for name in new_names if name not in _action_vertex_ids]
+    if missing:
+        # inject() ships the miss list as one parameter, so Neptune compiles
+        # one plan and runs it N times server-side (UNWIND-style bulk write)
+        created = g.inject(missing).unfold().as_('n').addV('action').property(
+            'name', __.select('n')
+        ).group().by('name').by(T.id).next()
+        _action_vertex_ids.update(_ids_by_name(created))
+
+def encode_policy_document(document: dict):
+    """
+    Serializes a policy document for storage on the policy vertex.
+    Returns (property_key, value): 'document_zstd' holding base64'd
+    zstd-compressed JSON when zstandard is available, 'document' with the
+    plain JSON string otherwise.
+    """
+    raw = json.dumps(document)
+    if _zstd_compressor is None:
+        return 'document', raw
+    compressed = _zstd_compressor.compress(raw.encode('utf-8'))
+    return 'document_zstd', base64.b64encode(compressed).decode('ascii')
+
+def decode_policy_document(value: str) -> dict:
+    """Decodes a 'document_zstd' property back into the policy document."""
+    return json.loads(_zstd_decompressor.decompress(base64.b64decode(value)))
+
+def _as_action_list(actions):
+    """IAM statements allow 'Action' to be a string or a list; normalize to a list."""
+    if actions is None:
+        return []
+    if isinstance(actions, str):
+        return [actions]
+    return actions
+
+def _concrete_actions(document: dict) -> list:
+    """
+    All non-wildcard actions allowed by a policy document, via a simplified
+    Statement/Action parser. Wildcard actions are skipped for now, focus on
+    specific (for I.E.I. calculation later).
+    """
+    return [
+        action
+        for statement in document.get('Statement', [])
+        if statement.get('Effect') == 'Allow'
+        for action in _as_action_list(statement.get('Action'))
+        if '*' not in action
+    ]
+
+def _bulk_load_via_s3(iam_data: list, used_actions_by_role: dict, start_time: datetime):
+    """
+    Stages the graph as Bulk Loader CSVs in S3 and submits one /loader job to
+    Neptune, polling until it finishes. Vertices get deterministic ids (the
+    role/policy ARN, the action name) so re-running a load is idempotent.
+    Only for first-time ingestion into an empty graph — the caller gates on
+    that, because these ids don't match the ones Neptune generated for
+    vertices written online.
+    """
+    start_iso = start_time.isoformat() if start_time else ''
+    now_iso = datetime.now(timezone.utc).isoformat()
+
+    def to_csv(header, rows):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(header)
+        writer.writerows(rows)
+        return buf.getvalue()
+
+    role_rows, policy_rows, action_rows, edge_rows = [], [], {}, {}
+    action_names = set()
+
+    for role_details in iam_data:
+        role_arn = role_details['arn']
+        role_rows.append([role_arn, 'role', role_arn, role_details['name'], role_details['account_id']])
+
+        for policy_data in role_details['policies']:
+            policy_arn = policy_data['arn']
+            doc_key, doc_value = encode_policy_document(policy_data['document'])
+            policy_rows.append([policy_arn, 'policy', policy_arn, policy_data['name'], policy_data['type'],
+                                doc_value if doc_key == 'document_zstd' else '',
+                                doc_value if doc_key == 'document' else ''])
+            edge_id = f"{role_arn}|HAS_POLICY|{policy_arn}"
+            edge_rows[edge_id] = [edge_id, role_arn, policy_arn, 'HAS_POLICY', '', '']
+
+            for action in _concrete_actions(policy_data['document']):
+                action_names.add(action)
+                edge_id = f"{policy_arn}|PERMITS|{action}"
+                edge_rows[edge_id] = [edge_id, policy_arn, action, 'PERMITS', '', '']
+
+    ingested_arns = {role_details['arn'] for role_details in iam_data}
+    for role_arn, used_actions in used_actions_by_role.items():
+        # Parity with the online path, which drops usage for roles outside
+        # the IAM payload: there is no vertex row for such an ARN, and a
+        # dangling ~from would abort the whole load
+        if role_arn not in ingested_arns:
+            continue
+        for action in used_actions:
+            action_names.add(action)
+            edge_id = f"{role_arn}|USED_ACTION|{action}"
+            edge_rows[edge_id] = [edge_id, role_arn, action, 'USED_ACTION', start_iso, now_iso]
+
+    action_rows = [[action, 'action', action] for action in sorted(action_names)]
+
+    # 1. Stage the CSVs under a unique run prefix
+    s3_client = boto3.client('s3')
+    prefix = f"neptune-load/{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}/"
+    files = {
+        'roles.csv': to_csv(['~id', '~label', 'arn:String', 'name:String', 'account_id:String'], role_rows),
+        'policies.csv': to_csv(['~id', '~label', 'arn:String', 'name:String', 'type:String',
+                                'document_zstd:String', 'document:String'], policy_rows),
+        'actions.csv': to_csv(['~id', '~label', 'name:String'], action_rows),
+        'edges.csv': to_csv(['~id', '~from', '~to', '~label', 'lookback_start:String', 'last_seen:String'],
+                            edge_rows.values()),
+    }
+    for name, body in files.items():
+        s3_client.put_object(Bucket=NEPTUNE_LOAD_S3_BUCKET, Key=prefix + name, Body=body.encode('utf-8'))
+
+    # 2. Submit the load job to Neptune's HTTPS loader endpoint
+    url = urlparse(NEPTUNE_ENDPOINT)
+    loader_url = f"https://{url.netloc}/loader"
+    payload = {
+        'source': f"s3://{NEPTUNE_LOAD_S3_BUCKET}/{prefix}",
+        'format': 'csv',
+        'iamRoleArn': NEPTUNE_LOADER_ROLE_ARN,
+        'region': os.environ.get('AWS_REGION', 'us-east-1'),
+        'parallelism': 'HIGH',
+        'mode': 'AUTO',
+        'updateSingleCardinalityProperties': 'TRUE',
+        # Abort loudly on malformed rows instead of silently dropping them
+        'failOnError': 'TRUE',
+    }
+    request = Request(loader_url, data=json.dumps(payload).encode('utf-8'),
+                      headers={'Content-Type': 'application/json'}, method='POST')
+    with urlopen(request) as response:
+        load_id = json.loads(response.read())['payload']['loadId']
+
+    # 3. Poll the job until Neptune reports a terminal status
+    while True:
+        with urlopen(f"{loader_url}/{load_id}") as response:
+            status = json.loads(response.read())['payload']['overallStatus']['status']
+        if status == 'LOAD_COMPLETED':
+            break
+        if status not in ('LOAD_NOT_STARTED', 'LOAD_IN_PROGRESS', 'LOAD_IN_QUEUE'):
+            raise RuntimeError(f"Neptune bulk load {load_id} ended in status {status}")
+        time.sleep(BULK_LOAD_POLL_SECONDS)
+
+    # The loader used the action name as the vertex id, so the online edge
+    # writers can keep addressing those vertices by id afterwards.
+    _action_vertex_ids.update({action: action for action in action_names})
+
+    print(f"Bulk-loaded {len(iam_data)} roles ({len(edge_rows)} edges) into Neptune via {prefix}.")
+
+def save_all_to_neptune(iam_data: list, used_actions_by_role: dict, start_time: datetime = None):
     """
-    Writes the collected IAM data (Roles and Policies) to the Neptune Graph.
-    This function uses 'upsert' logic to prevent creating duplicate nodes.
+    Writes the collected IAM data (Roles and Policies) and CloudTrail usage to
+    the Neptune Graph in a single pass: action vertices are bulk-upserted once
+    for both datasets, and each role's HAS_POLICY/PERMITS and USED_ACTION
+    edges ride the same compound traversal. Upsert logic prevents creating
+    duplicate nodes.
     """
+    used_actions_by_role = used_actions_by_role or {}
+
+    # Nothing to write (common at customer onboarding: no roles yet, or no
+    # recent activity) — skip the connection open entirely.
+    if not iam_data and not used_actions_by_role:
+        print("No IAM or usage data to save; skipping graph write.")
+        return
+
     g = get_graph_traversal()
     if g is None:
         print("Cannot save data: Graph connection failed.")
         return
 
-    # Counter for reporting
-    roles_processed = 0
+    # Large FIRST ingestions go through the S3 Bulk Loader instead of chatty
+    # (even batched) online Gremlin writes. The loader assigns deterministic
+    # vertex ids that don't match the ids Neptune generated for anything
+    # written online, so bulk loading over a non-empty graph would duplicate
+    # it — those payloads stay on the online path.
+    if (NEPTUNE_LOAD_S3_BUCKET and NEPTUNE_LOADER_ROLE_ARN
+            and len(iam_data) >= BULK_LOAD_MIN_ROLES
+            and not g.V().hasLabel('role').limit(1).hasNext()):
+        _bulk_load_via_s3(iam_data, used_actions_by_role, start_time)
+        return
+
+    # Every usage edge in this run shares the same timestamps; format them
+    # once instead of re-stringifying per role/action.
+    start_iso = start_time.isoformat() if start_time else None
+    now_iso = datetime.now(timezone.utc).isoformat()
 
     try:
-        for role_details in iam_data:
-            roles_processed += 1
+        # 0. Bulk-upsert every concrete action from both datasets in ONE
+        # traversal. inject() ships the whole list of names as a single
+        # parameter, so Neptune compiles one plan and runs it N times
+        # server-side instead of one coalesce program per action
+        # (UNWIND-style bulk write).
+        action_names = {
+            action
+            for role_details in iam_data
+            for policy_data in role_details['policies']
+            for action in _concrete_actions(policy_data['document'])
+        }
+        action_names.update(action for actions in used_actions_by_role.values() for action in actions)
+        _bulk_upsert_actions(g, action_names)
+
+        def usage_edge_step(action_ids):
+            # USED_ACTION edge upserts for the whole cached-id list in one
+            # fixed-size step: the list travels as a single within()
+            # parameter, so the compiled program doesn't grow with the
+            # action count. Context is stored as properties on the edge.
+            return __.V().hasId(P.within(action_ids)).coalesce(
+                # Find existing edge, or add a new one
+                __.inE('USED_ACTION').where(__.outV().where(P.eq('r'))),
+                __.addE('USED_ACTION').from_('r').property('lookback_start', start_iso)
+            ).property('last_seen', now_iso)
+
+        def write_role(role_details):
             role_arn = role_details['arn']
             role_name = role_details['name']
             account_id = role_details['account_id']
 
             # 1. Upsert the Role Node (V)
-            # Find the role by ARN, or add it if it doesn't exist
-            role_node = g.V().has('role', 'arn', role_arn).fold().coalesce(
+            # Find the role by ARN, or add it if it doesn't exist.
+            # Everything for this role (policies, actions, edges) is chained onto
+            # this one traversal so the whole role is written in a single
+            # round-trip to Neptune instead of 3-4 per policy/action.
+            role_traversal = g.V().has('role', 'arn', role_arn).fold().coalesce(
                 __.unfold(),
                 __.addV('role').property('arn', role_arn).property('name', role_name).property('account_id', account_id)
-            ).next()
+            ).as_('r')
 
             for policy_data in role_details['policies']:
                 policy_arn = policy_data['arn']
                 policy_name = policy_data['name']
                 policy_type = policy_data['type']
-                policy_doc = json.dumps(policy_data['document'])
+                doc_key, doc_value = encode_policy_document(policy_data['document'])
 
-                # 2. Upsert the Policy Node (V)
-                policy_node = g.V().has('policy', 'arn', policy_arn).fold().coalesce(
+                # 2. Upsert the Policy Node (V) and its HAS_POLICY Edge (E)
+                # as a side effect of the role traversal. The 'r' label can't
+                # be referenced here: it was applied before this child's
+                # fold(), which erases path history, so the edge branches
+                # re-resolve the role by its indexed arn instead.
+                policy_step = __.V().has('policy', 'arn', policy_arn).fold().coalesce(
                     __.unfold(),
-                    __.addV('policy').property('arn', policy_arn).property('name', policy_name).property('type', policy_type).property('document', policy_doc)
-                ).next()
-
-                # 3. Create HAS_POLICY Edge (E)
-                # Ensure the edge exists between Role and Policy
-                g.V(role_node).as_('r').V(policy_node).coalesce(
-                    __.inE('HAS_POLICY').where(__.outV().is_('r')),
-                    __.addE('HAS_POLICY').from_('r')
-                ).iterate()
-
-                # 4. Parse Policy Document to Upsert Action Nodes and PERMITS Edges
-                # This is a simplified parser for Statement/Action array
-                for statement in policy_data['document'].get('Statement', []):
-                    if statement.get('Effect') == 'Allow':
-                        actions = statement.get('Action')
-                        if isinstance(actions, str):
-                            actions = [actions]
-                        
-                        for action in actions:
-                            # Skip wildcard actions for now, focus on specific (for I.E.I. calculation later)
-                            if '*' not in action:
-                                # Upsert Action Node (V)
-                                action_node = g.V().has('action', 'name', action).fold().coalesce(
-                                    __.unfold(),
-                                    __.addV('action').property('name', action)
-                                ).next()
-                                
-                                # Create PERMITS Edge (E)
-                                g.V(policy_node).as_('p').V(action_node).coalesce(
-                                    __.inE('PERMITS').where(__.outV().is_('p')),
-                                    __.addE('PERMITS').from_('p')
-                                ).iterate()
-        
-        print(f"Successfully processed and wrote {roles_processed} roles and their full policy graph to Neptune.")
-        
+                    __.addV('policy').property('arn', policy_arn).property('name', policy_name).property('type', policy_type).property(doc_key, doc_value)
+                ).as_('p').coalesce(
+                    __.inE('HAS_POLICY').where(__.outV().has('role', 'arn', role_arn)),
+                    __.addE('HAS_POLICY').from_(__.V().has('role', 'arn', role_arn))
+                )
+
+                # 3. Link the (already upserted) Action Nodes with PERMITS
+                # Edges: the whole cached-id list rides one hasId(within())
+                # step, so the program stays the same size no matter how many
+                # actions the policy allows. Nested inside the policy side
+                # effect so the 'p' label stays in scope for the edge.
+                action_ids = [_action_vertex_ids[action] for action in _concrete_actions(policy_data['document'])]
+                if action_ids:
+                    policy_step = policy_step.sideEffect(
+                        __.V().hasId(P.within(action_ids)).coalesce(
+                            __.inE('PERMITS').where(__.outV().where(P.eq('p'))),
+                            __.addE('PERMITS').from_('p')
+                        )
+                    )
+
+                role_traversal = role_traversal.sideEffect(policy_step)
+
+            # 4. Append this role's USED_ACTION edges to the same traversal,
+            # so IAM and usage data go out in one round-trip per role
+            used_ids = [_action_vertex_ids[action] for action in used_actions_by_role.get(role_arn, ())]
+            if used_ids:
+                role_traversal = role_traversal.sideEffect(usage_edge_step(used_ids))
+
+            # 5. Submit the whole role as one compound traversal
+            role_traversal.iterate()
+
+        # Submit per-role traversals concurrently: each one is a network
+        # round-trip, so overlapping them keeps the connection pool busy
+        # instead of serializing every role on a single websocket.
+        with ThreadPoolExecutor(max_workers=NEPTUNE_POOL_SIZE) as executor:
+            # list() forces evaluation so worker exceptions propagate here
+            list(executor.map(write_role, iam_data))
+
+        # 6. Usage data for roles that weren't part of this IAM payload
+        # (e.g. roles deleted since the trail was written). Unknown role ARNs
+        # simply produce an empty traversal server-side.
+        ingested_arns = {role_details['arn'] for role_details in iam_data}
+        for role_arn, used_actions in used_actions_by_role.items():
+            if role_arn in ingested_arns:
+                continue
+            used_ids = [_action_vertex_ids[action] for action in used_actions]
+            if used_ids:
+                g.V().has('role', 'arn', role_arn).as_('r').sideEffect(usage_edge_step(used_ids)).iterate()
+
+        print(f"Successfully wrote {len(iam_data)} roles and usage data for {len(used_actions_by_role)} roles to Neptune.")
+
     except Exception as e:
         print(f"Critical error during graph write: {e}")
         # Re-raise the exception to inform the caller (the Lambda)
         raise
 
-    finally:
-        # Important: ensure the connection is closed
-        if g:
-            g.close()
-
-def save_cloudtrail_data_to_neptune(used_actions_by_role: dict, start_time: datetime):
+def _days_since_last_use(last_seen_iso: str, now: datetime) -> int:
     """
-    Writes CloudTrail usage data by creating USED_ACTION edges 
-    between Role nodes and Action nodes.
+    Days Since Last Use (DSLU) from a USED_ACTION 'last_seen' value, capped at
+    the 90-day lookback window. An empty value means no usage data exists, so
+    we assume the maximum risk score. All rows in one run share the same
+    'now', so callers read the clock once and pass it in.
     """
-    g = get_graph_traversal()
-    if g is None:
-        print("Cannot save usage data: Graph connection failed.")
-        return
+    if not last_seen_iso:
+        return 90
+    last_seen_date = datetime.fromisoformat(last_seen_iso.replace('Z', '+00:00'))
+    time_diff = now - last_seen_date
+    return min(time_diff.days, 90)
 
-    try:
-        # Loop through each Role ARN that had usage
-        for role_arn, used_actions in used_actions_by_role.items():
-            
-            # 1. Find the Role Node
-            role_node = g.V().has('role', 'arn', role_arn).tryNext()
-            
-            if not role_node.isPresent():
-                print(f"Warning: Role {role_arn} not found in graph. Skipping usage data.")
-                continue
+# Each metrics projection covers at most this many roles, so no single
+# traversal can blow past Neptune's query evaluation timeout on a large graph
+METRICS_CHUNK_SIZE = 50
 
-            # 2. Add USED_ACTION edge for each action
-            for action in used_actions:
-                
-                # Check if the Action node exists (it should, from S1.A2)
-                # If it doesn't, we still create it here to link the usage data
-                action_node = g.V().has('action', 'name', action).fold().coalesce(
-                    __.unfold(),
-                    __.addV('action').property('name', action)
-                ).next()
-                
-                # Create USED_ACTION Edge (E)
-                # We use properties on the edge to store context
-                g.V(role_node.get()).as_('r').V(action_node).coalesce(
-                    # Find existing edge, or add a new one
-                    __.inE('USED_ACTION').where(__.outV().is_('r')),
-                    __.addE('USED_ACTION').from_('r').property('lookback_start', start_time.isoformat())
-                ).property('last_seen', datetime.now(timezone.utc).isoformat()).iterate()
-                
-        print(f"Successfully updated graph with usage data for {len(used_actions_by_role)} roles.")
+def collect_all_role_metrics(g):
+    """
+    Fetches the I.E.I. metrics for EVERY role server-side: a cheap arn
+    listing, then one fused project() per chunk of METRICS_CHUNK_SIZE roles
+    (1 + N/50 round-trips instead of 1 + 3N per-role traversals).
+    Privilege Breadth is evaluated inside the traversal with math(), so only
+    the final double comes back instead of the raw action counts. Usage
+    Inactivity stays client-side: last_seen is an ISO-8601 string and the
+    math() expression engine has no date functions.
+    Yields (arn, metrics) pairs as Neptune streams the result batches, so
+    callers can overlap downstream work with the traversal I/O instead of
+    waiting for the full materialized list.
+    """
+    role_arns = g.V().hasLabel('role').values('arn').toList()
 
-    except Exception as e:
-        print(f"Critical error during CloudTrail usage write: {e}")
-        raise
+    # One clock read for the whole run instead of one per role
+    now = datetime.now(timezone.utc)
 
-    finally:
-        if g:
-            g.close()
-
-def calculate_role_metrics(g, role_arn: str):
-    """
-    Executes Gremlin traversals to get the three required metrics for the I.E.I. formula.
-    """
-    # 1. Total Allowed Actions (T.A.A.): Count of all 'Action' nodes linked by 'PERMITS'
-    taa_query = g.V().has('role', 'arn', role_arn).out('HAS_POLICY').out('PERMITS').dedup().count().next()
-    
-    # 2. Used Actions (U.A.): Count of all 'Action' nodes linked by 'USED_ACTION'
-    ua_query = g.V().has('role', 'arn', role_arn).out('USED_ACTION').dedup().count().next()
-
-    # 3. Days Since Last Use (DSLU): Get the max 'last_seen' property from 'USED_ACTION' edges
-    # If no USED_ACTION edge exists, the role is inactive for the full lookback period (90 days).
-    last_seen_iso = g.V().has('role', 'arn', role_arn).outE('USED_ACTION').values('last_seen').order().by(Order.desc).limit(1).tryNext()
-    
-    if last_seen_iso.isPresent():
-        last_seen_date = datetime.fromisoformat(last_seen_iso.get().replace('Z', '+00:00'))
-        # Calculate days since last use
-        time_diff = datetime.now(timezone.utc) - last_seen_date
-        dslu = min(time_diff.days, 90) # Cap at the lookback window
-    else:
-        # If no usage data exists, assume the maximum risk score
-        dslu = 90
-        
-    return {
-        'total_allowed_actions': taa_query,
-        'used_actions': ua_query,
-        'days_since_last_use': dslu,
-    }
+    for start in range(0, len(role_arns), METRICS_CHUNK_SIZE):
+        chunk = role_arns[start:start + METRICS_CHUNK_SIZE]
+        rows = g.V().has('role', 'arn', P.within(chunk)).project('arn', 'pb', 'last_seen').by('arn').by(
+            # PB = 50 * (TAA - UA) / TAA, computed in the engine. choose()
+            # guards the TAA == 0 division (math() would return NaN); the
+            # TAA == UA case falls out of the formula as 0 naturally.
+            __.choose(
+                __.out('HAS_POLICY').out('PERMITS').dedup().count().is_(0),
+                __.constant(0.0),
+                __.project('taa', 'ua').by(
+                    __.out('HAS_POLICY').out('PERMITS').dedup().count()
+                ).by(
+                    __.out('USED_ACTION').dedup().count()
+                ).math('50 * (taa - ua) / taa')
+            )
+        ).by(
+            # Most recent last_seen across the role's USED_ACTION edges,
+            # '' when the role has no recorded usage
+            __.coalesce(
+                __.outE('USED_ACTION').values('last_seen').order().by(Order.desc).limit(1),
+                __.constant('')
+            )
+        )
+
+        # Iterating the Traversal pulls result batches off the wire as they
+        # arrive rather than blocking on toList()
+        for row in rows:
+            yield row['arn'], {
+                'pb_score': float(row['pb']),
+                'days_since_last_use': _days_since_last_use(row['last_seen'], now),
+            }
 
@@ -26,6 +26,12 @@ resource "aws_dynamodb_table" "identity_exposure_metrics" {
     type = "S"
   }
 
+  # Auto-expire stale score rows so the table stays small and scans stay fast
+  ttl {
+    attribute_name = "ttl"
+    enabled        = true
+  }
+
   tags = {
     Name        = "IEI Metrics Table"
     Environment = var.environment